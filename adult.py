@@ -17,6 +17,7 @@
 import ConfigParser
 import argparse
 import csv
+import os
 import sys
 
 import scoutbook.util
@@ -52,8 +53,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Process Troopmaster Scout File")
 
     parser.add_argument('infile', type=argparse.FileType('rb'), metavar='Adult.txt')
-    parser.add_argument('outfile', nargs='?', type=argparse.FileType('wb', 0),
-                        metavar='adults.csv', default=sys.stdout)
+    parser.add_argument('outfile', nargs='?', type=str,
+                        metavar='adults.csv', default=None)
     parser.add_argument('--config', required=False, type=argparse.FileType('rb'),
                         metavar='scoutbook.cfg', default='scoutbook.cfg')
     parser.add_argument('--unit-number', type=str, metavar='Num', required=True,
@@ -62,26 +63,67 @@ if __name__ == '__main__':
                         help='Primary area code for member phone numbers.')
     parser.add_argument('--is-lds', action='store_true', default=False,
                         help='Set if this is an LDS troop.')
+    parser.add_argument('--max-rows', type=int, metavar='Num', default=None,
+                        help='Split the output into shards of at most this many rows.')
+    parser.add_argument('--max-bytes', type=int, metavar='Num', default=None,
+                        help='Split the output into shards of at most this many bytes.')
+    parser.add_argument('--max-warnings', type=int, metavar='Num', default=20,
+                        help='Only print this many warnings of each kind, the rest are counted.')
+    parser.add_argument('--warnings-file', type=str, metavar='warnings.csv', default=None,
+                        help='Write every warning to this CSV or JSON (.json) file.')
+    parser.add_argument('--validate-only', action='store_true', default=False,
+                        help='Check the input and report warnings without writing any output.')
+    parser.add_argument('--provenance', action='store_true', default=False,
+                        help='Record which input line each output row came from, see provenance.py.')
+    parser.add_argument('--progress', action='store_true', default=False,
+                        help='Show progress through the input on stderr.')
+    parser.add_argument('--progress-log', type=argparse.FileType('ab'), metavar='progress.log', default=None,
+                        help='Periodically append JSON progress records to this file.')
     args = parser.parse_args()
 
+    # Like argparse.FileType, '-' means write to stdout
+    if args.outfile == '-':
+        args.outfile = None
+
+    sharded = args.max_rows or args.max_bytes
+    if sharded and not args.outfile:
+        parser.error('an output file is required when using --max-rows or --max-bytes')
+    if args.provenance and not args.outfile:
+        parser.error('an output file is required when using --provenance')
+
     config = ConfigParser.ConfigParser(allow_no_value=True)
     config.optionxform = str # Makes items case sensitive
     config.readfp(args.config)
 
     scoutbook.util.init(config)
     
+    # Remember the full path so provenance.py works from any directory
+    source = os.path.abspath(args.infile.name)
+    collector = scoutbook.util.WarningCollector(args.max_warnings, source)
+    provenance = scoutbook.util.ProvenanceTable(source)
+
     header_order = scoutbook.util.create_header_array(header_string)
     
     output = []
     output.append(header_order)
 
-    reader = csv.DictReader(args.infile)
+    progress = None
+    infile = args.infile
+    if args.progress or args.progress_log:
+        progress = scoutbook.util.ProgressReporter(args.infile, args.progress, args.progress_log)
+        infile = progress.lines_of(args.infile)
 
+    reader = csv.DictReader(infile)
+
+    # A row can span lines so remember where each one starts, the first one
+    # starts right after the header.
+    line_number = 2
     for row in reader:
         # Just getting these values for debug purposes
         first = row[scoutbook.util.field_map['First Name']]
         last = row[scoutbook.util.field_map['Last Name']]
         bsaid = row[scoutbook.util.field_map['BSA Member ID']]
+        member = "%s %s (%s)" % (first, last, bsaid)
 
         newrow = []
         for header in header_order:
@@ -94,28 +136,68 @@ if __name__ == '__main__':
                 try:
                     value = field_fixups[header](value)
                 except ValueError, e:
-                    print "Warning %s (%s) is not valid for %s %s (%s). Defaulting to '%s'." % (header, value, first, last, bsaid, e)
+                    collector.warn('invalid-value', member, header, value,
+                                   "Warning %s (%s) is not valid for %s %s (%s). Defaulting to '%s'." % (header, value, first, last, bsaid, e),
+                                   line=line_number)
                     value = e
                 except scoutbook.util.InvalidPosition, e:
-                    print "Warning invalid position %s for %s %s (%s)." % (value,
-                                                                           first,
-                                                                           last,
-                                                                           bsaid)
+                    collector.warn('invalid-position', member, header, value,
+                                   "Warning invalid position %s for %s %s (%s)." % (value,
+                                                                                    first,
+                                                                                    last,
+                                                                                    bsaid),
+                                   line=line_number)
                     value = ''
                 except scoutbook.util.DuplicateEmail, e:
-                    print "Warning Duplicate Email %s for %s %s (%s)" % (value,
-                                                                         first,
-                                                                         last,
-                                                                         bsaid)
+                    collector.warn('duplicate-email', member, header, value,
+                                   "Warning Duplicate Email %s for %s %s (%s)" % (value,
+                                                                                  first,
+                                                                                  last,
+                                                                                  bsaid),
+                                   line=line_number)
 
             if header in required_fields and not value:
-                print "Warning missing %s field for %s %s (%s)" % (header,
-                                                                   first,
-                                                                   last,
-                                                                   bsaid)
+                collector.warn('missing-field', member, header, value,
+                               "Warning missing %s field for %s %s (%s)" % (header,
+                                                                            first,
+                                                                            last,
+                                                                            bsaid),
+                               line=line_number)
 
             newrow.append(value)
 
         output.append(newrow)
-
-    csv.writer(args.outfile).writerows(output)
+        provenance.add(line_number)
+        line_number = reader.line_num + 1
+        if progress:
+            progress.rows += 1
+
+    if progress:
+        progress.finish_input()
+
+    collector.summary()
+
+    if args.validate_only:
+        # Everything has been checked, there is nothing to write
+        pass
+    elif sharded:
+        writer = scoutbook.util.ShardedWriter(args.outfile, header_order,
+                                              args.max_rows, args.max_bytes)
+        writer.writerows(output[1:])
+        writer.close()
+    elif args.outfile:
+        with open(args.outfile, 'wb') as outfile:
+            csv.writer(outfile).writerows(output)
+    else:
+        csv.writer(sys.stdout).writerows(output)
+
+    if args.provenance and not args.validate_only:
+        provenance.save(scoutbook.util.provenance_name(args.outfile))
+
+    # Written last so a problem here can't cost us the converted data
+    if args.warnings_file:
+        collector.write(args.warnings_file)
+
+    # Everything has been written, let anyone watching the log know
+    if progress:
+        progress.finish()
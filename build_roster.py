@@ -0,0 +1,30 @@
+"""
+   Copyright 2015 Michael Parker
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import argparse
+
+import scoutbook.util
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Build a roster file from Troopmaster Scout and Adult Files")
+
+    parser.add_argument('scout_infile', type=argparse.FileType('rb'), metavar='Scout.txt')
+    parser.add_argument('adult_infile', type=argparse.FileType('rb'), metavar='Adult.txt')
+    parser.add_argument('outfile', type=str, metavar='roster.dat')
+    args = parser.parse_args()
+
+    scoutbook.util.build_roster_file(args.outfile, args.scout_infile, args.adult_infile)
@@ -17,21 +17,38 @@
 import ConfigParser
 import argparse
 import csv
+import os
 import re
+import struct
+import sys
 
 import scoutbook.util
 
 # This is the Scoutbook logs.csv output format
 #"BSA Member ID","First Name","Middle Name","Last Name","Log Type","Date","Nights","Days","Miles","Hours","Frost Points","Location/Name","Notes"
 
-def init_log_file(log_fp):
+log_header_string = '"BSA Member ID","First Name","Middle Name","Last Name","Log Type","Date","Nights","Days","Miles","Hours","Frost Points","Location/Name","Notes"'
+
+def init_log_file(filename, max_rows=None, max_bytes=None):
     """Initialize the given filename and return a csv writer object.
+
+    If max_rows or max_bytes is given the log is split into shards and a
+    ShardedWriter is returned instead, which must be closed when done.
     """
-    # Should be brand new but lets just make sure
-    log_fp.truncate()
+    if max_rows or max_bytes:
+        return scoutbook.util.ShardedWriter(filename,
+                                            scoutbook.util.create_header_array(log_header_string),
+                                            max_rows, max_bytes,
+                                            quoting=csv.QUOTE_ALL)
+
+    # Like argparse.FileType, '-' means write to stdout
+    if filename == '-':
+        log_fp = sys.stdout
+    else:
+        log_fp = open(filename, 'wb')
 
     # Go ahead and write out our header
-    log_fp.write('"BSA Member ID","First Name","Middle Name","Last Name","Log Type","Date","Nights","Days","Miles","Hours","Frost Points","Location/Name","Notes"\n')
+    log_fp.write(log_header_string + '\n')
 
     return csv.writer(log_fp, quoting=csv.QUOTE_ALL)
 
@@ -52,19 +69,19 @@ def output_service_record(record):
      location,
      remarks) = record
     
-    activity_file_mapping['Service'].writerow([bsa_id,        # BSA Member ID
-                                               first,         # First Name
-                                               middle_name,   # Middle Name
-                                               last,          # Last Name
-                                               'Service',     # Log Type
-                                               activity_date, # Date
-                                               '',            # Nights
-                                               '',            # Days
-                                               '',            # Miles
-                                               credit,        # Hours
-                                               '',            # Frost Points
-                                               location,      # Location/Name
-                                               remarks        # Note
+    write_log_row('Service', [bsa_id,        # BSA Member ID
+                              first,         # First Name
+                              middle_name,   # Middle Name
+                              last,          # Last Name
+                              'Service',     # Log Type
+                              activity_date, # Date
+                              '',            # Nights
+                              '',            # Days
+                              '',            # Miles
+                              credit,        # Hours
+                              '',            # Frost Points
+                              location,      # Location/Name
+                              remarks        # Note
     ])
 
 def output_hiking_record(record):
@@ -80,19 +97,19 @@ def output_hiking_record(record):
      location,
      remarks) = record
     
-    activity_file_mapping['Hiking'].writerow([bsa_id,        # BSA Member ID
-                                              first,         # First Name
-                                              middle_name,   # Middle Name
-                                              last,          # Last Name
-                                              'Hiking',      # Log Type
-                                              activity_date, # Date
-                                              '',            # Nights
-                                              '',            # Days
-                                              credit,        # Miles
-                                              '',            # Hours
-                                              '',            # Frost Points
-                                              location,      # Location/Name
-                                              remarks        # Note
+    write_log_row('Hiking', [bsa_id,        # BSA Member ID
+                             first,         # First Name
+                             middle_name,   # Middle Name
+                             last,          # Last Name
+                             'Hiking',      # Log Type
+                             activity_date, # Date
+                             '',            # Nights
+                             '',            # Days
+                             credit,        # Miles
+                             '',            # Hours
+                             '',            # Frost Points
+                             location,      # Location/Name
+                             remarks        # Note
     ])
 
 def output_camping_record(record):
@@ -115,19 +132,19 @@ def output_camping_record(record):
 
     # Troopmaster does not have a concept of Frost Points so just use 0
     
-    activity_file_mapping['Camping'].writerow([bsa_id,        # BSA Member ID
-                                               first,         # First Name
-                                               middle_name,   # Middle Name
-                                               last,          # Last Name
-                                               'Camping',     # Log Type
-                                               activity_date, # Date
-                                               str(nights),   # Nights
-                                               str(days),     # Days
-                                               '',            # Miles
-                                               '',            # Hours
-                                               '0',           # Frost Points
-                                               location,      # Location/Name
-                                               remarks        # Notes
+    write_log_row('Camping', [bsa_id,        # BSA Member ID
+                              first,         # First Name
+                              middle_name,   # Middle Name
+                              last,          # Last Name
+                              'Camping',     # Log Type
+                              activity_date, # Date
+                              str(nights),   # Nights
+                              str(days),     # Days
+                              '',            # Miles
+                              '',            # Hours
+                              '0',           # Frost Points
+                              location,      # Location/Name
+                              remarks        # Notes
     ])
 
 # This will hold a pointer to the csv writer object for each of these activities
@@ -137,6 +154,64 @@ activity_file_mapping = {
     'Hiking': None,
 }
 
+# Warnings are collected here rather than printed one by one
+warning_collector = scoutbook.util.WarningCollector()
+
+# Optional scoutbook.util.DuplicateFilter used to drop rows we have already output
+duplicate_filter = None
+
+# Where the row being output came from, as (line, activity block) in the report.
+# The output lambdas only take the record so parse_activity() sets this for them.
+current_source = (0, 0)
+
+# With --provenance this holds a scoutbook.util.ProvenanceTable for each activity
+activity_provenance_mapping = {}
+
+# Optional scoutbook.util.ProgressReporter for the report being parsed
+progress = None
+
+# When sorting is enabled this holds a scoutbook.util.ExternalSorter for each
+# activity, the sorted rows are written out once the whole report is parsed.
+activity_sorter_mapping = {}
+
+def log_sort_key(row):
+    """Group log rows by member and then order them by date.
+    """
+    (bsa_id, first, middle_name, last, log_type, activity_date) = row[:6]
+
+    # Dates are MM/DD/YYYY which doesn't sort, turn them into YYYYMMDD
+    try:
+        (month, day, year) = activity_date.split('/')
+        activity_date = '%s%02d%02d' % (year, int(month), int(day))
+    except ValueError:
+        pass
+
+    return (last.lower(), first.lower(), middle_name.lower(), bsa_id, activity_date)
+
+def write_log_row(log_type, row):
+    """Send a finished log row to the writer for the given log type.
+
+    Overlapping reports will list the same person at the same activity more
+    than once, if duplicate filtering is enabled those rows are dropped here.
+    """
+    if duplicate_filter:
+        # Not everyone has a BSA ID, fall back on their name
+        member = row[0] or ' '.join(row[1:4])
+        if duplicate_filter.seen(member, row[5], log_type, row[11]):
+            return
+
+    if progress:
+        progress.rows += 1
+
+    if activity_sorter_mapping:
+        # The source has to travel with the row since the order will change
+        activity_sorter_mapping[log_type].add(row + list(current_source))
+    elif activity_file_mapping[log_type]:
+        # There won't be a writer when we are only validating
+        activity_file_mapping[log_type].writerow(row)
+        if activity_provenance_mapping:
+            activity_provenance_mapping[log_type].add(*current_source)
+
 # Regular Expression necessary to parse the various fields from the report.
 # This should cover everything unless Troopmaster adds something that isn't covered.
 activity_fields = {
@@ -168,11 +243,42 @@ def check_match(exp, line):
     if m:
         return m.group(1).strip()
 
+# The output lambdas from the configuration only need to be evaluated once
+output_functions = {}
+
+# Names found in both the scout and adult data that we have already warned about
+reported_ambiguous_names = set()
+
+def lookup_output_function(activity_type):
+    """Output for each type is configurable so we must go lookup the output
+    function from the configuration.  Returns None for unsupported types.
+    """
+    output_function = scoutbook.util.lookup_mapping('Activity Output Lambdas',
+                                                    activity_type)
+    if not output_function:
+        return None
+
+    if output_function not in output_functions:
+        # function is just a string from the config, so eval it to use it
+        output_functions[output_function] = eval(output_function)
+    return output_functions[output_function]
+
 # Do the hard work
-def parse_activity(buf):
+def parse_activity(buf, first_line=1, block=0):
+    """Parse a single activity from the report.  buf holds the lines of the
+    activity, first_line is the line number of buf[0] in the report and block
+    is the number of the activity within the report.
+    """
+    global current_source
+
     found_matches = {}
     markername_p = False
-    for line in buf:
+
+    # Attendees are collected for the whole activity and then looked up in the
+    # scout and adult data all at once.
+    attendees = []
+
+    for (line_number, line) in enumerate(buf, first_line):
         # The markername appears right before we start seeing a list of names
         # this helps keep the activity metadata fields separate and avoids
         # some accidental parsing.
@@ -185,9 +291,6 @@ def parse_activity(buf):
                 credit = item[1]
                 first = item[3]
                 last = item[2]
-                
-                bsa_id = ''
-                middle_name = ''
 
                 # Credit value of 'X' means that we should use the overall
                 # activity value.
@@ -209,62 +312,47 @@ def parse_activity(buf):
                         # information its the best we can do I guess
                         credit = 0
 
-                # Attempt to find this person in the scout or adult data file
-                # this isn't perfect but as long as you don't have too many
-                # overlapping scouts/adults it will work well.
-                # If you do have some overlapping names then output Scout Only
-                # and Adult Only reports from Troopmaster and parse them separately.
-                key = "%s %s" % (first, last)
-                data = scoutbook.util.lookup_scout_by_name(key)
-                if data:
-                    bsa_id = data['member_id']
-                    first = data['first_name']
-                    middle_name = data['middle_name']
-                    last = data['last_name']
-                else:
-                    data = scoutbook.util.lookup_adult_by_name(key)
-                    if data:
-                        bsa_id = data['member_id']
-                        first = data['first_name']
-                        middle_name = data['middle_name']
-                        last = data['last_name']
-            
                 remarks = ''
                 if 'Remarks' in found_matches:
                     remarks = found_matches['Remarks']
 
-                if 'Location' not in found_matches:
-                    print "There is a problem."
-                    print line 
-                    print found_matches
-                    next
+                missing = False
+                for field in ['Location', 'Activity Date']:
+                    if field not in found_matches:
+                        warning_collector.warn('missing-field', "%s %s" % (first, last),
+                                               field, '',
+                                               "Warning missing %s for %s %s: %s" % (field,
+                                                                                     first,
+                                                                                     last,
+                                                                                     line.strip()),
+                                               line=line_number)
+                        missing = True
+                if missing:
+                    continue
 
                 try:
                     activity_type = found_matches['Activity Type']
                 except:
                     activity_type = None
 
-                # Output for each type is configurable so we must go lookup the output
-                # function from the configuration.  If the output function exists
-                # then it will be called, otherwise we log it as an unsupported
-                # activity type.
-                output_function = scoutbook.util.lookup_mapping('Activity Output Lambdas',
-                                                                activity_type)
-                if output_function:
-                    # function is just a string from the config, so eval it to use it
-                    output_function = eval(output_function)
-                    try:
-                        output_function(
-                            [bsa_id, first, middle_name, last,
-                            found_matches['Activity Date'],
-                            credit,
-                            found_matches['Location'],
-                             remarks])
-                    except:
-                        print buf
-                        raise
-                else:
-                    print "Unsupported Activity Type: %s" % (found_matches['Activity Type'],)
+                # If the output function exists then it will be called,
+                # otherwise we log it as an unsupported activity type.
+                output_function = lookup_output_function(activity_type)
+                if not output_function:
+                    warning_collector.warn('unsupported-activity', "%s %s" % (first, last),
+                                           'Activity Type', activity_type,
+                                           "Unsupported Activity Type: %s" % (activity_type,),
+                                           line=line_number)
+                    continue
+
+                attendees.append((output_function,
+                                  line_number,
+                                  "%s %s" % (first, last),
+                                  [first, last,
+                                   found_matches['Activity Date'],
+                                   credit,
+                                   found_matches['Location'],
+                                   remarks]))
         else:
             for act in activity_fields:
                 val = check_match(activity_fields[act], line)
@@ -272,6 +360,41 @@ def parse_activity(buf):
                     found_matches[act] = val
                     #print "%s: %s" % (act, val)
 
+    # Attempt to find everyone in the scout or adult data file.  Anyone that
+    # is in both can't be told apart here, so they are flagged rather than
+    # guessed at.  If you do have some overlapping names then output Scout Only
+    # and Adult Only reports from Troopmaster and parse them separately.
+    resolved = scoutbook.util.resolve_names(set([name for (output_function, line_number, name, fields) in attendees]))
+
+    for (output_function, line_number, name, fields) in attendees:
+        (first, last, activity_date, credit, location, remarks) = fields
+        bsa_id = ''
+        middle_name = ''
+
+        (kind, data) = resolved[name]
+        if data:
+            bsa_id = data['member_id']
+            first = data['first_name']
+            middle_name = data['middle_name']
+            last = data['last_name']
+        elif kind == scoutbook.util.AMBIGUOUS and name not in reported_ambiguous_names:
+            # Only report each name once, not for every activity they attended
+            reported_ambiguous_names.add(name)
+            warning_collector.warn('ambiguous-name', name, 'Name', name,
+                                   "Warning %s is both a scout and an adult, not filling in member details" % (name,),
+                                   line=line_number)
+
+        current_source = (line_number, block)
+        try:
+            output_function([bsa_id, first, middle_name, last,
+                             activity_date,
+                             credit,
+                             location,
+                             remarks])
+        except:
+            print buf
+            raise
+
 
 def main():
 
@@ -280,23 +403,70 @@ def main():
     parser.add_argument('infile', type=argparse.FileType('rb'))
     parser.add_argument('--config', required=True, type=argparse.FileType('rb'),
                         metavar='activity.cfg', default='activity.cfg')
-    parser.add_argument('--adult-infile', required=False, type=argparse.FileType('rb'),
+    parser.add_argument('--adult-infile', required=False, type=str,
                         metavar='Adult.txt', default='Adult.txt',
                         help='Troopmaster Adult export file.')
-    parser.add_argument('--scout-infile', required=False, type=argparse.FileType('rb'),
+    parser.add_argument('--scout-infile', required=False, type=str,
                         metavar='Scout.txt', default='Scout.txt',
                         help='Troopmaster Scout export file.')
-    parser.add_argument('--hiking-logs', required=False, type=argparse.FileType('wb'),
+    parser.add_argument('--roster-file', required=False, type=str,
+                        metavar='roster.dat', default=None,
+                        help='Roster file from build_roster.py, used instead of the Scout and Adult export files.')
+    parser.add_argument('--hiking-logs', required=False, type=str,
                         metavar='hikinglogs.csv', default='hikinglogs.csv',
                         help='CSV file containing Hiking information,')
-    parser.add_argument('--service-logs', required=False, type=argparse.FileType('wb'),
+    parser.add_argument('--service-logs', required=False, type=str,
                         metavar='servicelogs.csv', default='servicelogs.csv',
                         help='CSV file containing Service information,')
-    parser.add_argument('--camping-logs', required=False, type=argparse.FileType('wb'),
+    parser.add_argument('--camping-logs', required=False, type=str,
                         metavar='campinglogs.csv', default='campinglogs.csv',
                         help='CSV file containing Camping information,')
+    parser.add_argument('--max-rows', type=int, metavar='Num', default=None,
+                        help='Split each log file into shards of at most this many rows.')
+    parser.add_argument('--max-bytes', type=int, metavar='Num', default=None,
+                        help='Split each log file into shards of at most this many bytes.')
+    parser.add_argument('--dedup', action='store_true', default=False,
+                        help='Drop log entries that have already been output.')
+    parser.add_argument('--dedup-state', type=str, metavar='dedup.dat', default=None,
+                        help='Remember output log entries between runs in this file, implies --dedup.')
+    parser.add_argument('--sort', action='store_true', default=False,
+                        help='Sort log entries by member and date.')
+    parser.add_argument('--sort-memory', type=int, metavar='Num', default=64 * 1024 * 1024,
+                        help='Approximate number of bytes to use for sorting before spilling to disk.')
+    parser.add_argument('--max-warnings', type=int, metavar='Num', default=20,
+                        help='Only print this many warnings of each kind, the rest are counted.')
+    parser.add_argument('--warnings-file', type=str, metavar='warnings.csv', default=None,
+                        help='Write every warning to this CSV or JSON (.json) file.')
+    parser.add_argument('--validate-only', action='store_true', default=False,
+                        help='Check the report and report warnings without writing any logs.')
+    parser.add_argument('--provenance', action='store_true', default=False,
+                        help='Record which report line each log entry came from, see provenance.py.')
+    parser.add_argument('--progress', action='store_true', default=False,
+                        help='Show progress through the report on stderr.')
+    parser.add_argument('--progress-log', type=argparse.FileType('ab'), metavar='progress.log', default=None,
+                        help='Periodically append JSON progress records to this file.')
     args = parser.parse_args()
 
+    log_filenames = [args.camping_logs, args.service_logs, args.hiking_logs]
+    if (args.max_rows or args.max_bytes) and '-' in log_filenames:
+        parser.error('log files can not be written to stdout when using --max-rows or --max-bytes')
+    if args.provenance and '-' in log_filenames:
+        parser.error('log files can not be written to stdout when using --provenance')
+
+    warning_collector.max_samples = args.max_warnings
+    # Remember the full path so provenance.py works from any directory
+    warning_collector.source = os.path.abspath(args.infile.name)
+
+    global duplicate_filter, progress
+    if args.dedup or args.dedup_state:
+        duplicate_filter = scoutbook.util.DuplicateFilter()
+        if args.dedup_state and os.path.exists(args.dedup_state):
+            try:
+                with open(args.dedup_state, 'rb') as state_fp:
+                    duplicate_filter.load(state_fp)
+            except (IOError, ValueError), e:
+                parser.error(str(e))
+
     config = ConfigParser.ConfigParser(allow_no_value=True)
     config.optionxform = str # Makes items case sensitive
     config.readfp(args.config)
@@ -315,23 +485,96 @@ def main():
     # output files are generated at the same time we shouldn't get any unknown
     # entries.
     
-    scoutbook.util.read_scout_file(args.scout_infile)
-    scoutbook.util.read_adult_file(args.adult_infile)
-
-    activity_file_mapping['Camping'] = init_log_file(args.camping_logs)
-    activity_file_mapping['Service'] = init_log_file(args.service_logs)
-    activity_file_mapping['Hiking'] = init_log_file(args.hiking_logs)
+    try:
+        if args.roster_file:
+            scoutbook.util.open_roster_file(args.roster_file)
+        else:
+            with open(args.scout_infile, 'rb') as scout_fp:
+                scoutbook.util.read_scout_file(scout_fp)
+            with open(args.adult_infile, 'rb') as adult_fp:
+                scoutbook.util.read_adult_file(adult_fp)
+    except (IOError, ValueError, struct.error), e:
+        parser.error(str(e))
+
+    if not args.validate_only:
+        activity_file_mapping['Camping'] = init_log_file(args.camping_logs,
+                                                         args.max_rows, args.max_bytes)
+        activity_file_mapping['Service'] = init_log_file(args.service_logs,
+                                                         args.max_rows, args.max_bytes)
+        activity_file_mapping['Hiking'] = init_log_file(args.hiking_logs,
+                                                        args.max_rows, args.max_bytes)
+
+        if args.provenance:
+            for log_type in activity_file_mapping:
+                activity_provenance_mapping[log_type] = scoutbook.util.ProvenanceTable(warning_collector.source,
+                                                                                       blocks=True)
+
+        if args.sort:
+            for log_type in activity_file_mapping:
+                activity_sorter_mapping[log_type] = scoutbook.util.ExternalSorter(log_sort_key,
+                                                                                  args.sort_memory)
+
+    infile = args.infile
+    if args.progress or args.progress_log:
+        progress = scoutbook.util.ProgressReporter(args.infile, args.progress, args.progress_log)
+        progress.blocks = 0
+        infile = progress.lines_of(args.infile)
 
     buf = []
+    first_line = 1
+    block = 0
 
-    for line in args.infile:
+    for (line_number, line) in enumerate(infile, 1):
         if newreport.findall(line):
-            parse_activity(buf)
+            parse_activity(buf, first_line, block)
             buf = []
+            first_line = line_number + 1
+            block += 1
+            if progress:
+                progress.blocks = block
         else:
             buf.append(line)
     # We will be left with one file buffer to parse, so go parse that
-    parse_activity(buf)
+    parse_activity(buf, first_line, block)
+
+    if progress:
+        progress.finish_input()
+
+    for (log_type, sorter) in activity_sorter_mapping.items():
+        writer = activity_file_mapping[log_type]
+        provenance = activity_provenance_mapping.get(log_type)
+        for row in sorter.sorted():
+            writer.writerow(row[:-2])
+            if provenance is not None:
+                provenance.add(*row[-2:])
+
+    log_filenames = {
+        'Camping': args.camping_logs,
+        'Service': args.service_logs,
+        'Hiking': args.hiking_logs,
+    }
+    for (log_type, provenance) in activity_provenance_mapping.items():
+        provenance.save(scoutbook.util.provenance_name(log_filenames[log_type]))
+
+    # Sharded logs are written in the background, wait for them to finish
+    for writer in activity_file_mapping.values():
+        if isinstance(writer, scoutbook.util.ShardedWriter):
+            writer.close()
+
+    if duplicate_filter:
+        for log_type in sorted(activity_file_mapping):
+            print >> sys.stderr, "Dropped %d duplicate %s entries" % (duplicate_filter.duplicates.get(log_type, 0),
+                                                                      log_type)
+        if args.dedup_state and not args.validate_only:
+            duplicate_filter.save(args.dedup_state)
+
+    warning_collector.summary()
+    if args.warnings_file:
+        warning_collector.write(args.warnings_file)
+
+    # Everything has been written, let anyone watching the log know
+    if progress:
+        progress.finish()
     
 if __name__ == '__main__':
     main()
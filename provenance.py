@@ -0,0 +1,134 @@
+"""
+   Copyright 2015 Michael Parker
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import argparse
+import csv
+import os
+import re
+import struct
+import sys
+
+import scoutbook.util
+
+# Shards are named like campinglogs-002.csv
+shard_name = re.compile(r'^(.*)-(\d+)(\.[^.]*)?$')
+
+def find_provenance(filename, row):
+    """Find the provenance table for an output file along with the index of
+    the given row in it.  Rows are numbered the same as the lines of the output
+    file, so the header is row 1.  Shards are looked up through their manifest.
+    """
+    index = row - 2
+
+    if not os.path.exists(scoutbook.util.provenance_name(filename)):
+        m = shard_name.match(filename)
+        if m:
+            (base, number, ext) = m.groups()
+            with open("%s-manifest.csv" % (base,), 'rb') as manifest_fp:
+                for entry in csv.DictReader(manifest_fp):
+                    if int(shard_name.match(entry['Shard']).group(2)) < int(number):
+                        index += int(entry['Rows'])
+            filename = base + (ext or '')
+
+    table_name = scoutbook.util.provenance_name(filename)
+    table = scoutbook.util.ProvenanceTable.load(table_name)
+    if index < 0 or index >= len(table):
+        raise IndexError('row %d is not in %s' % (row, filename))
+
+    (line, block) = table.lookup(index)
+    return (source_path(table.source, table_name), line, block)
+
+def source_path(source, relative_to):
+    """Sources are recorded with their full path, but older files may have a
+    relative one.  Take those to be relative to the file they were found in.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(relative_to)), source)
+
+def encode_output(text):
+    """JSON warnings files give us unicode, which can't be printed when stdout
+    is a pipe, so encode it first.
+    """
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+def encode_path(path):
+    """Turn a path read back from a JSON warnings file into bytes again.  The
+    warnings file decoded it as UTF-8, falling back on cp1252, so try them in
+    the same order.
+    """
+    if not isinstance(path, unicode):
+        return path
+    encoded = path.encode('utf-8')
+    if not os.path.exists(encoded):
+        try:
+            encoded = path.encode('cp1252')
+        except UnicodeEncodeError:
+            pass
+    return encoded
+
+def show_source(source, line, context):
+    """Print the given line of the source file along with some context.
+    """
+    with open(source, 'rb') as source_fp:
+        for (line_number, text) in enumerate(source_fp, 1):
+            if line_number > line + context:
+                break
+            if line_number >= line - context:
+                marker = '>' if line_number == line else ' '
+                sys.stdout.write("%s%6d: %s" % (marker, line_number, text))
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Show where an output row or warning came from")
+
+    parser.add_argument('outfile', type=str, metavar='campinglogs.csv',
+                        help='Output file, shard or (with --warnings) warnings file.')
+    parser.add_argument('row', type=int, metavar='Num',
+                        help='Row of the output file (the header is row 1) or warning number.')
+    parser.add_argument('--warnings', action='store_true', default=False,
+                        help='outfile is a warnings file written with --warnings-file.')
+    parser.add_argument('--context', type=int, metavar='Num', default=2,
+                        help='Number of lines to show before and after the source line.')
+    args = parser.parse_args()
+
+    if args.warnings:
+        warnings = scoutbook.util.read_warnings_file(args.outfile)
+        if args.row < 1 or args.row > len(warnings):
+            parser.error('there is no warning %d in %s' % (args.row, args.outfile))
+        warning = warnings[args.row - 1]
+        if not warning['source'] or not warning['line']:
+            parser.error('warning %d does not have a source line' % (args.row,))
+        print encode_output(warning['message'])
+        (source, line, block) = (source_path(encode_path(warning['source']), args.outfile),
+                                 int(warning['line']), None)
+    else:
+        try:
+            (source, line, block) = find_provenance(args.outfile, args.row)
+        except (IOError, IndexError, ValueError, struct.error), e:
+            parser.error(str(e))
+
+    if block is None:
+        print encode_output("%s line %d" % (source, line))
+    else:
+        print encode_output("%s line %d (activity %d)" % (source, line, block))
+    try:
+        show_source(source, line, args.context)
+    except IOError, e:
+        parser.error(str(e))
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,22 @@
    limitations under the License.
 """
 
+import Queue
+import array
+import cStringIO
+import cPickle
+import collections
 import csv
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
 
 class InvalidPosition(Exception):
     pass
@@ -197,6 +212,9 @@ def read_scout_file(filep):
                                                'last_name': row['Last Name'],
             }
 
+    # The combined name index will need to be rebuilt
+    reset_roster_index()
+
 def lookup_scout_by_name(name):
     """Utility function to lookup scout information by name.
     """
@@ -250,6 +268,9 @@ def read_adult_file(filep):
                                                'last_name': row['Last Name'],
             }
 
+    # The combined name index will need to be rebuilt
+    reset_roster_index()
+
 def lookup_adult_by_name(name):
     """Utility function to lookup adult information by name.
     """
@@ -270,3 +291,824 @@ def lookup_adult_by_member_id(member_id):
         pass
     return None
 
+
+# Returned by resolve_names() for names found in both the scout and adult data
+AMBIGUOUS = 'ambiguous'
+
+def normalize_name(name):
+    """Names in reports don't always match the case or spacing of the export
+    files, so compare them lowercased with single spaces.
+    """
+    return ' '.join(name.lower().split())
+
+roster_by_name = {}
+resolved_names = {}
+def reset_roster_index():
+    roster_by_name.clear()
+    resolved_names.clear()
+
+def build_roster_index():
+    """Combine the scout and adult names into a single normalized index that
+    records which roster(s) each name was found in.
+    """
+    for (kind, by_name) in [('scout', scouts_by_name), ('adult', adults_by_name)]:
+        for (name, data) in by_name.items():
+            roster_by_name.setdefault(normalize_name(name), {})[kind] = data
+
+def resolve_names(names):
+    """Look up a batch of "First Last" names in the scout and adult data.
+
+    Returns a dictionary mapping each name to a (kind, data) tuple.  kind is
+    'scout' or 'adult' along with the same data lookup_scout_by_name() and
+    lookup_adult_by_name() return, AMBIGUOUS if the name is in both with data
+    of None, or (None, None) if the name wasn't found at all.  Each name is
+    only looked up once, the answers are remembered for later batches.
+
+    If a roster file has been opened with open_roster_file() it is used
+    instead of the scout and adult data read from the export files.
+    """
+    if not roster_file and not roster_by_name:
+        build_roster_index()
+
+    result = {}
+    for name in names:
+        if name not in resolved_names:
+            if roster_file:
+                matches = roster_file.lookup_name(normalize_name(name))
+            else:
+                matches = roster_by_name.get(normalize_name(name))
+            if not matches:
+                resolved_names[name] = (None, None)
+            elif len(matches) > 1:
+                resolved_names[name] = (AMBIGUOUS, None)
+            else:
+                resolved_names[name] = matches.items()[0]
+        result[name] = resolved_names[name]
+
+    return result
+
+# Layout of a roster file built by build_roster_file().  Everything is little
+# endian.  After the header come the following sections, in order:
+#
+#   string offsets   (strings + 1) uint32, string N is table[off[N]:off[N+1]]
+#   string table     all of the strings packed together
+#   kind column      records uint32, 0 for a scout and 1 for an adult
+#   first column     records uint32 string numbers
+#   middle column    records uint32 string numbers
+#   last column      records uint32 string numbers
+#   member_id column records uint32 string numbers
+#   name keys        names uint32 string numbers of normalized names, sorted
+#   name records     names uint32 record numbers matching the name keys
+#   member_id index  ids uint32 record numbers sorted by member_id
+roster_magic = 'TMROSTR1'
+roster_header = struct.Struct('<8sIIIII') # magic, records, strings, table size, names, ids
+roster_kinds = ['scout', 'adult']
+
+def build_roster_file(filename, scout_fp, adult_fp):
+    """Build a roster file from the Troopmaster scout and adult export files.
+
+    The roster file can be memory mapped by RosterFile so that very large
+    rosters can be searched without reading and parsing the export files
+    every time.
+    """
+    strings = {'': 0}
+    def string_number(value):
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    columns = [[], [], [], [], []]
+    names = []
+    ids = []
+    for (kind, filep) in enumerate([scout_fp, adult_fp]):
+        for row in csv.DictReader(filep):
+            record = len(columns[0])
+            member_id = row['BSA ID#']
+            for (column, value) in zip(columns, [kind,
+                                                 string_number(row['First Name']),
+                                                 string_number(row['Middle Name']),
+                                                 string_number(row['Last Name']),
+                                                 string_number(member_id)]):
+                column.append(value)
+
+            names.append((normalize_name("%s %s" % (row['First Name'], row['Last Name'])),
+                          record))
+            if row['Nickname']:
+                names.append((normalize_name("%s %s" % (row['Nickname'], row['Last Name'])),
+                              record))
+            if member_id:
+                ids.append((member_id, record))
+
+    names = [(string_number(key), key, record) for (key, record) in names]
+    names.sort(key=lambda name: (name[1], name[2]))
+    ids.sort()
+
+    table = [None] * len(strings)
+    for (value, number) in strings.items():
+        table[number] = value
+    offsets = [0]
+    for value in table:
+        offsets.append(offsets[-1] + len(value))
+
+    def pack(values):
+        return struct.pack('<%dI' % len(values), *values)
+
+    with open(filename, 'wb') as roster_fp:
+        roster_fp.write(roster_header.pack(roster_magic, len(columns[0]), len(table),
+                                           offsets[-1], len(names), len(ids)))
+        roster_fp.write(pack(offsets))
+        roster_fp.write(''.join(table))
+        for column in columns:
+            roster_fp.write(pack(column))
+        roster_fp.write(pack([number for (number, key, record) in names]))
+        roster_fp.write(pack([record for (number, key, record) in names]))
+        roster_fp.write(pack([record for (member_id, record) in ids]))
+
+class RosterFile(object):
+    """Memory mapped access to a roster file written by build_roster_file().
+
+    Nothing is read up front, lookups binary search the sorted indexes in the
+    mapped file so startup is immediate and the operating system can share the
+    pages between several conversions running at once.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as roster_fp:
+            self.map = mmap.mmap(roster_fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.records, self.strings, table_size,
+         self.names, self.ids) = roster_header.unpack_from(self.map, 0)
+        if magic != roster_magic:
+            raise ValueError('%s is not a roster file' % (filename,))
+
+        self.offsets = roster_header.size
+        self.table = self.offsets + 4 * (self.strings + 1)
+
+        section = self.table + table_size
+        sections = []
+        for count in [self.records] * 5 + [self.names] * 2 + [self.ids]:
+            sections.append(section)
+            section += 4 * count
+        (self.kind_column,
+         self.first_column,
+         self.middle_column,
+         self.last_column,
+         self.member_id_column,
+         self.name_keys,
+         self.name_records,
+         self.id_records) = sections
+
+        if section != len(self.map):
+            raise ValueError('%s is not a complete roster file' % (filename,))
+
+    def close(self):
+        self.map.close()
+
+    def uint(self, section, index):
+        return struct.unpack_from('<I', self.map, section + 4 * index)[0]
+
+    def string(self, number):
+        (start, end) = struct.unpack_from('<II', self.map, self.offsets + 4 * number)
+        return self.map[self.table + start:self.table + end]
+
+    def column(self, section, record):
+        return self.string(self.uint(section, record))
+
+    def record(self, record):
+        """Return the kind of the record along with the same data
+        lookup_scout_by_name() and lookup_adult_by_name() return.
+        """
+        return (roster_kinds[self.uint(self.kind_column, record)],
+                { 'member_id': self.column(self.member_id_column, record),
+                  'first_name': self.column(self.first_column, record),
+                  'middle_name': self.column(self.middle_column, record),
+                  'last_name': self.column(self.last_column, record),
+                })
+
+    def search(self, count, value_of, value):
+        """Binary search for the first index whose value is not less than the
+        given value.
+        """
+        (low, high) = (0, count)
+        while low < high:
+            mid = (low + high) // 2
+            if value_of(mid) < value:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def lookup_name(self, key):
+        """Look up a normalized name.  Returns a dictionary mapping the kind
+        ('scout' or 'adult') to the member data, empty if there was no match.
+        """
+        name_key = lambda index: self.string(self.uint(self.name_keys, index))
+        index = self.search(self.names, name_key, key)
+
+        matches = {}
+        while index < self.names and name_key(index) == key:
+            (kind, data) = self.record(self.uint(self.name_records, index))
+            matches[kind] = data
+            index += 1
+        return matches
+
+    def lookup_member_id(self, member_id):
+        """Look up a BSA member id.  Returns a dictionary mapping the kind
+        ('scout' or 'adult') to the member data, empty if there was no match.
+        """
+        record_id = lambda index: self.column(self.member_id_column,
+                                              self.uint(self.id_records, index))
+        index = self.search(self.ids, record_id, member_id)
+
+        matches = {}
+        while index < self.ids and record_id(index) == member_id:
+            (kind, data) = self.record(self.uint(self.id_records, index))
+            matches[kind] = data
+            index += 1
+        return matches
+
+roster_file = None
+def open_roster_file(filename):
+    """Use the given roster file for resolve_names() lookups.
+    """
+    global roster_file
+    roster_file = RosterFile(filename)
+    reset_roster_index()
+
+class ShardedWriter(object):
+    """A csv writer look-alike that splits the output into multiple files once
+    a maximum number of rows or bytes has been reached.  Scoutbook only accepts
+    so much in a single import, so years of history have to be broken up.
+
+    Every shard gets its own copy of the header.  Finished shards are handed to
+    a small pool of threads to be written out while the next one is being
+    filled.  Closing the writer waits for all of the shards and then writes a
+    manifest listing the rows, bytes and SHA-256 checksum of each shard so the
+    uploads can be done in parallel and verified afterwards.
+
+    Given scouts.csv the shards will be scouts-001.csv, scouts-002.csv, ...
+    and the manifest will be scouts-manifest.csv.
+    """
+
+    def __init__(self, filename, header, max_rows=None, max_bytes=None,
+                 workers=4, **fmtparams):
+        (self.base, self.ext) = os.path.splitext(filename)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+
+        # Rows are formatted into a scratch buffer so we know their exact size
+        # before deciding which shard they belong in.
+        self.scratch = cStringIO.StringIO()
+        self.formatter = csv.writer(self.scratch, **fmtparams)
+        self.header = self.format_row(header)
+
+        self.shard_count = 0
+        self.chunks = []
+        self.rows = 0
+        self.bytes = 0
+
+        self.manifest = []
+        self.errors = []
+        self.lock = threading.Lock()
+
+        # Bound the queue so we never hold more than a few shards in memory
+        self.queue = Queue.Queue(workers)
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.write_shards)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def format_row(self, row):
+        self.scratch.seek(0)
+        self.scratch.truncate()
+        self.formatter.writerow(row)
+        return self.scratch.getvalue()
+
+    def shard_name(self, number):
+        return "%s-%03d%s" % (self.base, number, self.ext)
+
+    def manifest_name(self):
+        return "%s-manifest.csv" % (self.base,)
+
+    def writerow(self, row):
+        data = self.format_row(row)
+
+        # A shard always gets at least one row, even if that row on its own is
+        # larger than max_bytes.
+        if self.rows:
+            if self.max_rows and self.rows + 1 > self.max_rows:
+                self.finish_shard()
+            elif (self.max_bytes and
+                  len(self.header) + self.bytes + len(data) > self.max_bytes):
+                self.finish_shard()
+
+        self.chunks.append(data)
+        self.rows += 1
+        self.bytes += len(data)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def finish_shard(self):
+        self.shard_count += 1
+        self.queue.put((self.shard_count, self.rows, self.chunks))
+        self.chunks = []
+        self.rows = 0
+        self.bytes = 0
+
+    def write_shards(self):
+        """Thread worker, write out shards until we are told to stop.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            (number, rows, chunks) = item
+            filename = self.shard_name(number)
+            checksum = hashlib.sha256()
+            size = 0
+            try:
+                with open(filename, 'wb') as shard_fp:
+                    for data in [self.header] + chunks:
+                        shard_fp.write(data)
+                        checksum.update(data)
+                        size += len(data)
+            except Exception, e:
+                with self.lock:
+                    self.errors.append(e)
+                continue
+
+            with self.lock:
+                self.manifest.append((number, filename, rows, size,
+                                      checksum.hexdigest()))
+
+    def close(self):
+        """Write out the last shard, wait for all of the writers to finish and
+        write the manifest.  Returns the manifest entries.
+        """
+        if self.rows or not self.shard_count:
+            self.finish_shard()
+
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        self.manifest.sort()
+        with open(self.manifest_name(), 'wb') as manifest_fp:
+            writer = csv.writer(manifest_fp)
+            writer.writerow(['Shard', 'Rows', 'Bytes', 'SHA256'])
+            for (number, filename, rows, size, checksum) in self.manifest:
+                writer.writerow([os.path.basename(filename), rows, size, checksum])
+
+        return self.manifest
+
+class DuplicateFilter(object):
+    """Keep track of which log entries have already been output so that
+    overlapping activity reports don't give someone credit twice.
+
+    An entry is identified by the member, date, log type and location.  Only a
+    short digest of those values is kept for each entry so this stays small
+    even with many years of history.  The digests can be saved and loaded
+    again to catch duplicates against earlier runs.
+    """
+
+    digest_size = 8
+
+    def __init__(self):
+        self.fingerprints = set()
+        self.duplicates = {}
+
+    def fingerprint(self, member, date, log_type, location):
+        key = '\0'.join([member, date, log_type, location]).lower()
+        return hashlib.sha1(key).digest()[:self.digest_size]
+
+    def seen(self, member, date, log_type, location):
+        """Return True if this entry has been seen before, otherwise remember
+        it and return False.  Duplicates are counted by log type.
+        """
+        fingerprint = self.fingerprint(member, date, log_type, location)
+        if fingerprint in self.fingerprints:
+            self.duplicates[log_type] = self.duplicates.get(log_type, 0) + 1
+            return True
+
+        self.fingerprints.add(fingerprint)
+        return False
+
+    def load(self, filep):
+        """Load fingerprints previously written out by save().
+        """
+        data = filep.read()
+        if len(data) % self.digest_size:
+            raise ValueError('%s is not a valid duplicate state file' % (filep.name,))
+        for i in range(0, len(data), self.digest_size):
+            self.fingerprints.add(data[i:i + self.digest_size])
+
+    def save(self, filename):
+        """Save the fingerprints to the given file.  They are written to a
+        temporary file first and then renamed into place so an interrupted save
+        can't lose the fingerprints from earlier runs.
+        """
+        (fd, temp_name) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, 'wb') as filep:
+                filep.write(''.join(self.fingerprints))
+            # mkstemp only gives the owner access, use the normal permissions
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_name, 0666 & ~umask)
+            os.rename(temp_name, filename)
+        except:
+            os.remove(temp_name)
+            raise
+
+class ExternalSorter(object):
+    """Sort more rows than we want to hold in memory at once.
+
+    Rows are collected until roughly max_memory bytes have been used, then they
+    are sorted and spilled to a temporary file as a sorted run.  Once all of the
+    rows have been added the runs are merged back together.  Rows with equal
+    keys come back out in the order they were added.
+
+    Runs are kept in levels.  Spilled runs start at level 0 and whenever
+    max_runs runs build up at one level they are merged into a single run at
+    the next level, so each row is only rewritten once per level no matter how
+    much history there is.
+    """
+
+    # Never merge more than this many runs at once so we don't run out of
+    # file handles.
+    max_runs = 64
+
+    # Rough per-field cost of a python string on top of its contents
+    field_overhead = 40
+
+    def __init__(self, key, max_memory=64 * 1024 * 1024):
+        self.key = key
+        self.max_memory = max_memory
+        self.buffer = []
+        self.memory = 0
+        self.count = 0
+        self.runs = [] # (level, run) pairs
+
+    def add(self, row):
+        self.buffer.append((self.key(row), self.count, row))
+        self.count += 1
+        self.memory += sum([len(str(value)) + self.field_overhead for value in row])
+        if self.memory > self.max_memory:
+            self.spill()
+
+    def spill(self):
+        """Sort what we have in memory and write it out as a new run.
+        """
+        self.buffer.sort()
+        self.runs.append((0, self.write_run(self.buffer)))
+        self.buffer = []
+        self.memory = 0
+
+        level = 0
+        while True:
+            runs = [run for (run_level, run) in self.runs if run_level == level]
+            if len(runs) < self.max_runs:
+                break
+            self.runs = [(run_level, run) for (run_level, run) in self.runs
+                         if run_level != level]
+            self.runs.append((level + 1, self.merge_runs(runs)))
+            level += 1
+
+    def merge_runs(self, runs):
+        """Merge the given runs into a single new run, closing the old ones.
+        """
+        merged = self.write_run(heapq.merge(*[self.read_run(run) for run in runs]))
+        for run in runs:
+            run.close()
+        return merged
+
+    def write_run(self, items):
+        run = tempfile.TemporaryFile()
+        for item in items:
+            cPickle.dump(item, run, cPickle.HIGHEST_PROTOCOL)
+        return run
+
+    def read_run(self, run):
+        run.seek(0)
+        while True:
+            try:
+                yield cPickle.load(run)
+            except EOFError:
+                return
+
+    def sorted(self):
+        """Return the rows in sorted order.  Should only be called once all of
+        the rows have been added.
+        """
+        if not self.runs:
+            self.buffer.sort()
+            items = self.buffer
+            runs = []
+        else:
+            if self.buffer:
+                self.spill()
+            runs = [run for (level, run) in self.runs]
+            self.runs = []
+
+            # There can still be up to max_runs - 1 runs left at each level,
+            # bring them down to something we can merge in one go.
+            while len(runs) > self.max_runs:
+                groups = [runs[i:i + self.max_runs] for i in range(0, len(runs), self.max_runs)]
+                runs = [self.merge_runs(group) if len(group) > 1 else group[0]
+                        for group in groups]
+            items = heapq.merge(*[self.read_run(run) for run in runs])
+
+        for (key, count, row) in items:
+            yield row
+
+        for run in runs:
+            run.close()
+        self.buffer = []
+
+WarningRecord = collections.namedtuple('WarningRecord',
+                                       ['code', 'member', 'field', 'value', 'message',
+                                        'source', 'line'])
+
+class WarningCollector(object):
+    """Collect the warnings issued while converting data.
+
+    Dirty exports can produce a huge number of warnings, so only the first
+    max_samples messages of each code are printed as they happen.  Everything
+    is kept and counted by code so that a summary can be printed and the full
+    list written out to a JSON or CSV file at the end.  A max_samples of None
+    prints every warning.
+
+    Each warning records the line of the source file it came from so that it
+    can be found again with provenance.py.
+    """
+
+    def __init__(self, max_samples=20, source=None):
+        self.max_samples = max_samples
+        self.source = source
+        self.records = []
+        self.counts = {}
+
+    def warn(self, code, member, field, value, message, line=None):
+        count = self.counts.get(code, 0) + 1
+        self.counts[code] = count
+        self.records.append(WarningRecord(code, member, field, value, message,
+                                          self.source, line))
+
+        if self.max_samples is None or count <= self.max_samples:
+            print message
+
+    def summary(self):
+        """Print out the number of warnings seen for each code.  This goes to
+        stderr so it can't end up in CSV output written to stdout.
+        """
+        if not self.counts:
+            return
+
+        print >> sys.stderr, "Warning summary:"
+        for code in sorted(self.counts):
+            count = self.counts[code]
+            if self.max_samples is not None and count > self.max_samples:
+                print >> sys.stderr, "  %s: %d (%d not shown)" % (code, count,
+                                                                  count - self.max_samples)
+            else:
+                print >> sys.stderr, "  %s: %d" % (code, count)
+
+    def write(self, filename):
+        """Write all of the warnings out to the given file.  Files ending in
+        .json are written as JSON, anything else as CSV.
+        """
+        if filename.lower().endswith('.json'):
+            # Troopmaster exports aren't necessarily UTF-8, anything that isn't
+            # is taken to be cp1252.  Build the whole thing before opening the
+            # file so a problem doesn't leave half of it behind.
+            data = json.dumps([dict([(field, decode_export_string(value))
+                                     for (field, value) in record._asdict().items()])
+                               for record in self.records], indent=2)
+            with open(filename, 'wb') as filep:
+                filep.write(data)
+            return
+
+        with open(filename, 'wb') as filep:
+            writer = csv.writer(filep)
+            writer.writerow(['Code', 'Member', 'Field', 'Value', 'Message',
+                             'Source', 'Line'])
+            writer.writerows(self.records)
+
+def decode_export_string(value):
+    """Turn a byte string from a Troopmaster export into unicode.  Exports
+    are usually cp1252 but try UTF-8 first, anything that isn't a string is
+    returned as is.
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('cp1252', 'replace')
+
+def read_warnings_file(filename):
+    """Read back a file written by WarningCollector.write().  Returns a list
+    of dictionaries keyed by the WarningRecord field names.
+    """
+    with open(filename, 'rb') as filep:
+        if filename.lower().endswith('.json'):
+            return json.load(filep)
+
+        reader = csv.reader(filep)
+        reader.next()
+        return [dict(zip(WarningRecord._fields, row)) for row in reader]
+
+provenance_magic = 'TMPROV01'
+provenance_header = struct.Struct('<8sIII') # magic, rows, has blocks, source length
+
+class ProvenanceTable(object):
+    """Remember where each row of an output file came from.
+
+    Rather than keeping anything per row, the source line of each row (and the
+    activity block for logs) is appended to a compact array, so row N of the
+    output is entry N of the arrays.  The table is saved next to the output and
+    read back by provenance.py.
+
+    Saved tables are always little endian with 4 byte entries, regardless of
+    the machine that wrote them.
+    """
+
+    def __init__(self, source, blocks=False):
+        self.source = source
+        self.lines = array.array('I')
+        self.blocks = None
+        if blocks:
+            self.blocks = array.array('I')
+
+    def __len__(self):
+        return len(self.lines)
+
+    def add(self, line, block=None):
+        self.lines.append(line)
+        if self.blocks is not None:
+            self.blocks.append(block)
+
+    def lookup(self, index):
+        """Return the (line, block) the given output row came from, where index
+        0 is the first row after the header.  block is None for files without
+        activity blocks.
+        """
+        block = None
+        if self.blocks is not None:
+            block = self.blocks[index]
+        return (self.lines[index], block)
+
+    def save(self, filename):
+        with open(filename, 'wb') as filep:
+            filep.write(provenance_header.pack(provenance_magic, len(self.lines),
+                                               self.blocks is not None, len(self.source)))
+            filep.write(self.source)
+            filep.write(struct.pack('<%dI' % len(self.lines), *self.lines))
+            if self.blocks is not None:
+                filep.write(struct.pack('<%dI' % len(self.blocks), *self.blocks))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as filep:
+            (magic, rows, blocks, source_length) = provenance_header.unpack(
+                filep.read(provenance_header.size))
+            if magic != provenance_magic:
+                raise ValueError('%s is not a provenance file' % (filename,))
+
+            table = cls(filep.read(source_length), blocks)
+            table.lines.extend(struct.unpack('<%dI' % rows, filep.read(4 * rows)))
+            if blocks:
+                table.blocks.extend(struct.unpack('<%dI' % rows, filep.read(4 * rows)))
+        return table
+
+def provenance_name(filename):
+    """Provenance for scouts.csv is kept in scouts-provenance.dat
+    """
+    return "%s-provenance.dat" % (os.path.splitext(filename)[0],)
+
+class ProgressReporter(object):
+    """Report progress through an input file.
+
+    Progress is based on how far into the file we have read, along with how
+    many lines, output rows and activity blocks have been processed.  Read the
+    file through lines_of() and bump the rows and blocks counters as you go.
+
+    Looking at the clock is only done every check_every lines and the display
+    is only redrawn every interval seconds so this costs next to nothing.  If a
+    log file is given a JSON progress record is appended to it every
+    log_interval seconds for scheduled jobs to pick up.  Only the record
+    written by finish() is marked as done.
+    """
+
+    check_every = 1000
+
+    def __init__(self, filep, display=True, log_fp=None, interval=1.0, log_interval=30.0):
+        try:
+            self.total = os.fstat(filep.fileno()).st_size
+        except (AttributeError, OSError):
+            self.total = 0
+        self.source = filep.name
+        self.display = display
+        self.log_fp = log_fp
+        self.interval = interval
+        self.log_interval = log_interval
+
+        self.position = 0
+        self.lines = 0
+        self.rows = 0
+        self.blocks = None
+
+        self.countdown = self.check_every
+        self.width = 0
+        self.start = time.time()
+        self.next_display = self.start + interval
+        self.next_log = self.start + log_interval
+
+    def lines_of(self, filep):
+        """Iterate over the lines of filep, keeping track of our position.
+        """
+        for line in filep:
+            self.position += len(line)
+            self.lines += 1
+            self.countdown -= 1
+            if not self.countdown:
+                self.countdown = self.check_every
+                self.check()
+            yield line
+
+    def check(self):
+        now = time.time()
+        if self.display and now >= self.next_display:
+            self.next_display = now + self.interval
+            self.show(self.status(now))
+        if self.log_fp and now >= self.next_log:
+            self.next_log = now + self.log_interval
+            self.log(self.status(now))
+
+    def status(self, now, done=False):
+        elapsed = max(now - self.start, 0.001)
+        status = collections.OrderedDict([
+            ('time', round(now, 3)),
+            ('source', self.source),
+            ('done', done),
+            ('position', self.position),
+            ('total', self.total),
+            ('percent', None),
+            ('lines', self.lines),
+            ('rows', self.rows),
+            ('blocks', self.blocks),
+            ('elapsed', round(elapsed, 3)),
+            ('lines_per_sec', round(self.lines / elapsed, 1)),
+            ('rows_per_sec', round(self.rows / elapsed, 1)),
+            ('eta', None),
+        ])
+        if self.total:
+            status['percent'] = round(100.0 * self.position / self.total, 1)
+            if self.position:
+                status['eta'] = round(elapsed * (self.total - self.position) / self.position, 1)
+        return status
+
+    def show(self, status, end=''):
+        message = "%d lines (%d/s), %d rows (%d/s)" % (status['lines'],
+                                                       status['lines_per_sec'],
+                                                       status['rows'],
+                                                       status['rows_per_sec'])
+        if status['blocks'] is not None:
+            message += ", %d activities" % (status['blocks'],)
+        if status['percent'] is not None:
+            message = "%5.1f%% %s" % (status['percent'], message)
+        if status['eta'] is not None:
+            message += ", ETA %d:%02d" % divmod(int(status['eta']), 60)
+        # Pad out to cover anything left over from the last, longer, message
+        self.width = max(self.width, len(message))
+        sys.stderr.write("\r%s%s" % (message.ljust(self.width), end))
+        sys.stderr.flush()
+
+    def log(self, status):
+        self.log_fp.write(json.dumps(status) + '\n')
+        self.log_fp.flush()
+
+    def finish_input(self):
+        """Report the final numbers once the whole file has been read.  There
+        may still be output to write so this isn't logged as done.
+        """
+        status = self.status(time.time())
+        if self.display:
+            self.show(status, '\n')
+        if self.log_fp:
+            self.log(status)
+
+    def finish(self):
+        """Log that the run is done, call once all of the output is written.
+        """
+        if self.log_fp:
+            self.log(self.status(time.time(), True))